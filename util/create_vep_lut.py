@@ -12,21 +12,25 @@ SHIFT_RH = 72000
 
 
 def duplicates(keys, values):
-    dct = {}
-    duplicates = []
-    for k, v in zip(keys, values):
-        if k in dct:
-            duplicates.append((k, dct[k], v))
-        else:
-            dct[k] = v
-    return duplicates
+    # (key, values) for every row of the 2D array `keys` occurring more than once
+    uniq, inverse, counts = np.unique(keys, axis=0, return_inverse=True, return_counts=True)
+    inverse = inverse.ravel()
+    return [(tuple(uniq[u].tolist()), values[inverse == u].tolist())
+            for u in np.flatnonzero(counts > 1)]
 
 
 def create_luts(fs_lut_file, vep_rules_file, vep_regions_file,
                 vep_fs_lut_file, vep_mrtrix_lut_file, vep_subcort_file, vep_aparc_lut_file):
 
-    # Load original table
-    fs_regs = list(np.genfromtxt(fs_lut_file, usecols=(1,), dtype=str))
+    # Load original table, keeping the raw lines to copy them to the new one
+    with open(fs_lut_file) as fl:
+        fs_lut_lines = fl.readlines()
+    fs_regs = []
+    for line in fs_lut_lines:
+        fields = line.split('#', 1)[0].split(None, 2)
+        if fields:
+            fs_regs.append(fields[1])
+    fs_regs_set = set(fs_regs)
 
     # Load rules
     rules = load_rules(vep_rules_file)
@@ -40,88 +44,100 @@ def create_luts(fs_lut_file, vep_rules_file, vep_regions_file,
     # Filter temp regions
     newregs = [reg for reg in newregs if reg not in ["%%%d" % i for i in range(10)]]
     assert all(["%H" in reg for reg in newregs])
+    newregs_set = set(newregs)
 
-    vep_regs = np.genfromtxt(vep_regions_file, usecols=(1,), dtype=str)
-    vep_iscort = np.genfromtxt(vep_regions_file, usecols=(0,), dtype=int).astype(bool)
-    vep_colors = np.genfromtxt(vep_regions_file, usecols=(2,3,4,5), dtype=int)
+    vep_table = np.loadtxt(vep_regions_file, dtype='U128', comments='#')
+    vep_regs = vep_table[:, 1]
+    vep_iscort = vep_table[:, 0].astype(int).astype(bool)
+    vep_colors = vep_table[:, 2:6].astype(int)
 
-    duplicate_colors = duplicates(map(tuple, vep_colors), vep_regs)
+    duplicate_colors = duplicates(vep_colors, vep_regs)
     if len(duplicate_colors) > 0:
         raise ValueError(f"Duplicates in the color table: {duplicate_colors}")
 
 
     # Make sure that every cortical region is in rules
     for reg in vep_regs[vep_iscort]:
-        if ("%%H-%s" % reg) not in newregs:
+        if ("%%H-%s" % reg) not in newregs_set:
             raise Exception("Rule for region '%s' is missing" % reg)
 
     # Make sure that every subcortical region is either in rules or in Freesurfer table
     for reg in vep_regs[~vep_iscort]:
-        assert ("%H-"+reg in newregs) or (("Left-"+reg in fs_regs) and ("Right-"+reg in fs_regs))
+        assert ("%H-"+reg in newregs_set) or (("Left-"+reg in fs_regs_set) and ("Right-"+reg in fs_regs_set))
 
 
     # Make sure all subcortical regions are at the end
     assert np.all(vep_iscort[:-1] >= vep_iscort[1:])
 
-    create_vep_fs_lut(vep_regs, vep_colors, fs_regs, fs_lut_file, vep_fs_lut_file)
-    create_vep_mrtrix_lut(vep_regs, vep_fs_lut_file, vep_mrtrix_lut_file)
-    create_subcort_list(vep_regs[~vep_iscort], vep_fs_lut_file, vep_subcort_file)
-    create_parc_lut(vep_regs[vep_iscort], vep_fs_lut_file, vep_aparc_lut_file)
+    create_vep_fs_lut(vep_regs, vep_colors, fs_regs_set, fs_lut_lines, vep_fs_lut_file)
+
+    # Parse the new table once and share it among the derived tables
+    lut = pd.read_csv(vep_fs_lut_file, sep=r'\s+', comment='#', header=None, engine='c',
+                      usecols=[0, 1, 2, 3, 4, 5], dtype={1: str}, keep_default_na=False)
+    names = lut[1].tolist()
+    inds = lut[0].to_numpy()
+    colors = lut[[2, 3, 4, 5]].to_numpy()
+    name_to_idx = {name: i for i, name in enumerate(names)}
+
+    create_vep_mrtrix_lut(vep_regs, name_to_idx, colors, vep_mrtrix_lut_file)
+    create_subcort_list(vep_regs[~vep_iscort], name_to_idx, inds, vep_subcort_file)
+    create_parc_lut(vep_regs[vep_iscort], name_to_idx, colors, vep_aparc_lut_file)
 
 
-def create_parc_lut(vep_regs, vep_fs_lut_file, vep_aparc_lut_file):
-    names = list(np.genfromtxt(vep_fs_lut_file, usecols=(1,), dtype=str))
-    colors = np.genfromtxt(vep_fs_lut_file, usecols=(2,3,4,5), dtype=int)
+def create_parc_lut(vep_regs, name_to_idx, colors, vep_aparc_lut_file):
+    colors = colors.tolist()
+    lines = ["  0 %-60s   0   0   0   0\n" % "Unknown"]
+    for i, reg in enumerate(vep_regs):
+        ind = name_to_idx["Left-" + reg]
+        lines.append("%3d %-60s %3d %3d %3d %3d\n" % (i+1, reg, *colors[ind]))
 
     with open(vep_aparc_lut_file, 'w') as fl:
-        fl.write("  0 %-60s   0   0   0   0\n" % "Unknown")
-        for i, reg in enumerate(vep_regs):
-            ind = names.index("Left-" + reg)
-            fl.write("%3d %-60s %3d %3d %3d %3d\n" % (i+1, reg, *colors[ind]))
+        fl.write("".join(lines))
 
 
-def create_vep_fs_lut(vep_regs, vep_colors, fs_regs, fs_lut_file, vep_fs_lut_file):
-    with open(fs_lut_file) as fl:
-        lines = fl.readlines()
-    with open(vep_fs_lut_file, "w") as fl:
-        fl.writelines(lines)
-        fl.write("\n\n#\n# Labels for the VEP parcellation\n#\n\n")
+def create_vep_fs_lut(vep_regs, vep_colors, fs_regs, fs_lut_lines, vep_fs_lut_file):
+    lines = list(fs_lut_lines)
+    lines.append("\n\n#\n# Labels for the VEP parcellation\n#\n\n")
 
-        for hemi, hnum in [('Left', SHIFT_LH), ('Right', SHIFT_RH)]:
-            i = 1
-            for reg, color in zip(vep_regs, vep_colors):
-                full_reg_name = hemi + "-" + reg
-                if full_reg_name in fs_regs:
-                    continue
+    vep_colors = vep_colors.tolist()
+    for hemi, hnum in [('Left', SHIFT_LH), ('Right', SHIFT_RH)]:
+        i = 1
+        for reg, color in zip(vep_regs, vep_colors):
+            full_reg_name = hemi + "-" + reg
+            if full_reg_name in fs_regs:
+                continue
+
+            lines.append("%5d  %-60s %3d %3d %3d %2d\n" % (hnum + i, full_reg_name, *color))
+            i += 1
 
-                fl.write("%5d  %-60s %3d %3d %3d %2d\n" % (hnum + i, full_reg_name, *color))
-                i += 1
+    with open(vep_fs_lut_file, "w") as fl:
+        fl.write("".join(lines))
 
 
-def create_vep_mrtrix_lut(vep_regs, vep_fs_lut_file, vep_mrtrix_lut_file):
-    names = list(np.genfromtxt(vep_fs_lut_file, usecols=(1,), dtype=str))
-    colors = np.genfromtxt(vep_fs_lut_file, usecols=(2,3,4,5), dtype=int)
+def create_vep_mrtrix_lut(vep_regs, name_to_idx, colors, vep_mrtrix_lut_file):
+    colors = colors.tolist()
+    lines = ["   0   %-60s  0   0   0   0\n" % ("Unknown")]
+    i = 1
+    for hemi in ['Left', 'Right']:
+        for reg in vep_regs:
+            regname = hemi + "-" + reg
+            ind = name_to_idx[regname]
+            lines.append("%4d   %-60s  %4d %4d %4d %4d\n" % (i, regname, *colors[ind]))
+            i += 1
 
     with open(vep_mrtrix_lut_file, 'w') as fl:
-        fl.write("   0   %-60s  0   0   0   0\n" % ("Unknown") )
-        i = 1
-        for hemi in ['Left', 'Right']:
-            for reg in vep_regs:
-                regname = hemi + "-" + reg
-                ind = names.index(regname)
-                fl.write("%4d   %-60s  %4d %4d %4d %4d\n" % (i, regname, *colors[ind]))
-                i += 1
+        fl.write("".join(lines))
 
 
-def create_subcort_list(vep_subcort_regions, vep_fs_lut, vep_subcort_list):
-    fs_names = list(np.genfromtxt(vep_fs_lut, usecols=(1,), dtype=str))
-    fs_inds = np.genfromtxt(vep_fs_lut, usecols=(0,), dtype=int)
+def create_subcort_list(vep_subcort_regions, name_to_idx, fs_inds, vep_subcort_list):
+    lines = []
+    for hemi in ['Left', 'Right']:
+        for reg in vep_subcort_regions:
+            name = hemi + "-" + reg
+            lines.append("%d\n" % fs_inds[name_to_idx[name]])
 
     with open(vep_subcort_list, 'w') as fl:
-        for hemi in ['Left', 'Right']:
-            for reg in vep_subcort_regions:
-                name = hemi + "-" + reg
-                fl.write("%d\n" % fs_inds[fs_names.index(name)])
+        fl.write("".join(lines))
 
 
 
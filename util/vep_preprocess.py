@@ -5,13 +5,17 @@ for statistical models with Stan.
 """
 
 import os
+import fnmatch
 import glob
 import json
 import logging
+import multiprocessing
 import pickle
 import zipfile
 
 import numpy as np
+import pandas as pd
+import scipy.fft
 import scipy.signal
 import mne
 
@@ -22,48 +26,51 @@ except:
     pass
 import pycmdstan as pcs
 
+RETRO_PROC_ROOT = '/home/vep/RetrospectivePatients/1-Processed'
 
-def compute_raw_slp(raw, cfg):
+
+def compute_raw_slp(raw, cfg, workers=1):
     nperseg: int = cfg.get('nperseg', 4 * int(raw.info['sfreq']))
     hpf: float = cfg.get('hpf', 10.0)
     lpf: float = cfg.get('lpf', 100.0)
-    Cs = []
-    for y in raw._data:
+    # one call for all channels, C is (n_channels, n_freqs, n_times)
+    with scipy.fft.set_workers(workers):
         F, T, C = scipy.signal.spectrogram(
-            y, raw.info['sfreq'], nperseg=nperseg)
-        fmask = np.ones(F.shape, 'bool')
-        if hpf:
-            fmask *= F > hpf
-        if lpf:
-            fmask *= F < lpf
-        Cs.append(np.log(C[fmask].sum(axis=0)))
-    Cs = np.array(Cs)
+            raw._data, raw.info['sfreq'], nperseg=nperseg, axis=-1)
+    # F is sorted, so hpf < F < lpf is a contiguous band: slice, don't mask
+    lo = np.searchsorted(F, hpf, side='right') if hpf else 0
+    hi = np.searchsorted(F, lpf, side='left') if lpf else F.size
+    Cs = np.empty((C.shape[0], C.shape[2]), np.float32)
+    np.log(C[:, lo:hi].sum(axis=1), out=Cs)
     return Cs
 
 
 def read_gain(subj_proc_dir):
     np_fname = os.path.join(subj_proc_dir,
                             'elec/gain_inv-square.destrieux.txt')
-    return np.loadtxt(np_fname)
+    return pd.read_csv(np_fname, sep=r'\s+', header=None, dtype=np.float64,
+                       engine='c', float_precision='round_trip').to_numpy()
 
 
-def _process_one_fif(js, cfg):
+def _process_one_fif(js, cfg, workers=1):
     exclude = js['bad_channels'] + js['non_seeg_channels']
     fif_fname = os.path.join(os.path.dirname(js['_source']), js['filename'])
-    raw = mne.io.Raw(fif_fname, verbose='WARNING')
+    raw = mne.io.Raw(fif_fname, preload=False, verbose='WARNING')
     picks = set(raw.ch_names) - set(exclude)
     assert js['onset'] is not None and js['termination'] is not None
+    # crop & pick before loading so only the needed samples are read
     raw.crop(tmin=js['onset'], tmax=js['termination'])
-    raw.load_data()
     raw.pick_channels(picks)
-    slp = compute_raw_slp(raw, cfg)
+    raw.load_data()
+    slp = compute_raw_slp(raw, cfg, workers)
     return picks, slp, raw.ch_names
 
 
-def _process_one_bids_vhdr(vhdrname, cfg):
-    raw = mne.io.read_raw_brainvision(vhdrname, preload=True)
+def _process_one_bids_vhdr(vhdrname, cfg, workers=1):
+    raw = mne.io.read_raw_brainvision(vhdrname, preload=False)
     raw = raw.pick_types(meg=False, eeg=True)
-    slp = compute_raw_slp(raw, cfg)
+    raw.load_data()
+    slp = compute_raw_slp(raw, cfg, workers)
     return set(raw.ch_names), slp, raw.ch_names
 
 
@@ -78,9 +85,19 @@ def _is_seizure(js) -> bool:
     return js['type'] == 'Spontaneous seizure'
 
 
+def _list_fif_dir(subj_proc_dir, pattern='*') -> [os.PathLike]:
+    path: str = os.path.join(subj_proc_dir, 'seeg/fif')
+    if not os.path.isdir(path):
+        return []
+    # skip dotfiles like glob does, e.g. macOS ._*.json AppleDouble files
+    with os.scandir(path) as entries:
+        return [entry.path for entry in entries
+                if entry.is_file() and not entry.name.startswith('.')
+                and fnmatch.fnmatch(entry.name, pattern)]
+
+
 def _read_all_jsons(subj_proc_dir):
-    pattern: str = os.path.join(subj_proc_dir, 'seeg/fif/*.json')
-    matches: [os.PathLike] = glob.glob(pattern)
+    matches: [os.PathLike] = _list_fif_dir(subj_proc_dir, '*.json')
     for match in matches:
         yield _load_js(match)
 
@@ -92,11 +109,6 @@ def _many_picks_intersection(many_picks: [set], gain_labels: set):
     return first
 
 
-def _is_bids(subj_proc_dir):
-    # return True if no fifs found (not great, but..)
-    return len(list(_read_all_jsons(subj_proc_dir))) == 0
-
-
 def _find_vhdrs(subj_proc_dir):
     subj_id = os.path.basename(subj_proc_dir)
     raw_path = os.path.join(subj_proc_dir, '..', '..', '0-Raw', subj_id)
@@ -104,16 +116,18 @@ def _find_vhdrs(subj_proc_dir):
     return glob.glob(vhdr_pattern)
 
 
-def read_all_seeg_data(subj_proc_dir, gain_labels, cfg: dict):
+def read_all_seeg_data(subj_proc_dir, gain_labels, cfg: dict, workers=1):
     # read all datasets
     data = []
-    if _is_bids(subj_proc_dir):
+    jsons = list(_read_all_jsons(subj_proc_dir))
+    # assume BIDS if no fifs found (not great, but..)
+    if not jsons:
         for vhdr in _find_vhdrs(subj_proc_dir):
-            data.append(_process_one_bids_vhdr(vhdr, cfg))
+            data.append(_process_one_bids_vhdr(vhdr, cfg, workers))
     else:
-        for js in _read_all_jsons(subj_proc_dir):
+        for js in jsons:
             if _is_seizure(js):
-                data.append(_process_one_fif(js, cfg))
+                data.append(_process_one_fif(js, cfg, workers))
     picks, slps, chs = zip(*data)
     # find intersection of channels across datasets
     picks = _many_picks_intersection(picks, gain_labels)
@@ -148,26 +162,31 @@ def read_weights(subj_proc_dir):
     fname = os.path.join(subj_proc_dir, 'tvb/connectivity.destrieux.zip')
     with zipfile.ZipFile(fname) as zf:
         with zf.open('weights.txt') as fd:
-            weights = np.loadtxt(fd)
+            weights = pd.read_csv(fd, sep=r'\s+', header=None,
+                                  dtype=np.float64, engine='c',
+                                  float_precision='round_trip').to_numpy()
         with zf.open('centres.txt', 'r') as fd:
             for line in fd.readlines():
                 roi_name, *_ = line.decode('ascii').strip().split(' ')
                 roi_names.append(roi_name)
-    weights_triu = weights[np.triu_indices(weights.shape[0], 1)]
+    rows, cols = np.triu_indices(weights.shape[0], 1)
+    weights_triu = weights[rows, cols]
     return weights_triu, roi_names
 
 
-def build_data(subj_proc_dir, cfg=None):
+def build_data(subj_proc_dir, cfg=None, workers=1):
     cfg = cfg or {}
     counts_triu, roi_names = read_weights(subj_proc_dir)
     gain = read_gain(subj_proc_dir)
     seeg_xyz = read_seeg_xyz(subj_proc_dir)
     seeg_xyz_names = set([label for label, _ in seeg_xyz])
     picks, slp, ch_names, is_first = read_all_seeg_data(
-        subj_proc_dir, seeg_xyz_names, cfg)
+        subj_proc_dir, seeg_xyz_names, cfg, workers)
     gain_pick = np.array(
         [i for i, (label, _) in enumerate(seeg_xyz) if label in picks])
-    gain = gain[gain_pick]
+    # float32 is plenty for the model and halves memory and cache size
+    gain = gain[gain_pick].astype(np.float32)
+    counts_triu = counts_triu.astype(np.float32)
     data = dict(
         nn=gain.shape[1],
         ns=gain.shape[0],
@@ -180,14 +199,15 @@ def build_data(subj_proc_dir, cfg=None):
 
 
 def retro_proc_dir(id):
-    return os.path.join('/home/vep/RetrospectivePatients/1-Processed', id)
+    return os.path.join(RETRO_PROC_ROOT, id)
 
 
 def retro_ids():
-    return [
-        os.path.basename(_)
-        for _ in glob.glob(retro_proc_dir('id*'))
-    ]
+    if not os.path.isdir(RETRO_PROC_ROOT):
+        return []
+    # ids are the entry names, no need to build and split full paths
+    with os.scandir(RETRO_PROC_ROOT) as entries:
+        return fnmatch.filter([entry.name for entry in entries], 'id*')
 
 
 def ensure_vep_topic_dir(subj_proc_dir):
@@ -196,22 +216,75 @@ def ensure_vep_topic_dir(subj_proc_dir):
         os.mkdir(path)
 
 
-def build_and_save_one(subj_proc_dir, cfg=None):
+def _input_fnames(subj_proc_dir):
+    fnames = [
+        os.path.join(subj_proc_dir, 'elec/gain_inv-square.destrieux.txt'),
+        os.path.join(subj_proc_dir, 'elec/seeg.xyz'),
+        os.path.join(subj_proc_dir, 'tvb/connectivity.destrieux.zip'),
+    ]
+    fnames += _list_fif_dir(subj_proc_dir)
+    for vhdr in _find_vhdrs(subj_proc_dir):
+        # header plus its .eeg & .vmrk payloads
+        fnames += glob.glob(os.path.splitext(vhdr)[0] + '.*')
+    return fnames
+
+
+def _cache_is_fresh(cache_fname, input_fnames):
+    if not os.path.exists(cache_fname):
+        return False
+    cache_mtime = os.path.getmtime(cache_fname)
+    return all(os.path.getmtime(fname) < cache_mtime
+               for fname in input_fnames if os.path.exists(fname))
+
+
+def _load_npz(npz_fname):
+    with np.load(npz_fname) as npz:
+        return {k: v.item() if v.ndim == 0 else v for k, v in npz.items()}
+
+
+def _save_npz(npz_fname, data):
+    # write aside & rename, so an interrupted run can't leave a fresh cache
+    tmp_fname = npz_fname + '.tmp'
+    with open(tmp_fname, 'wb') as fd:
+        np.savez_compressed(fd, **data)
+    os.replace(tmp_fname, npz_fname)
+
+
+def build_and_save_one(subj_proc_dir, cfg=None, workers=1):
     ensure_vep_topic_dir(subj_proc_dir)
     cfg_ = ''.join([f'-{k}_{v}' for k, v in cfg.items()]) if cfg else ''
     Rfname = os.path.join(subj_proc_dir, 'vep', f'data{cfg_}.R')
-    if os.path.exists(Rfname):
-        print(f'skipping existing {Rfname}')
-        return
-    data = build_data(subj_proc_dir, cfg)
-    plot_dataset(subj_proc_dir, data)
-    pcs.rdump(Rfname, data)
+    npzfname = os.path.join(subj_proc_dir, 'vep', f'data{cfg_}.npz')
+    # the .npz is newer than all inputs & the .R is newer than the .npz
+    if _cache_is_fresh(npzfname, _input_fnames(subj_proc_dir)):
+        if _cache_is_fresh(Rfname, [npzfname]):
+            print(f'skipping up to date {Rfname}')
+            return
+        data = _load_npz(npzfname)
+    else:
+        data = build_data(subj_proc_dir, cfg, workers)
+        _save_npz(npzfname, data)
+    # diagnostic figure is slow to render, only on request
+    if os.environ.get('VEP_PLOT'):
+        plot_dataset(subj_proc_dir, data)
+    tmp_Rfname = Rfname + '.tmp'
+    pcs.rdump(tmp_Rfname, data)
+    os.replace(tmp_Rfname, Rfname)
+
+
+def _build_and_save_retro(id):
+    # single-threaded FFTs, the pool already runs subjects in parallel
+    build_and_save_one(retro_proc_dir(id), workers=1)
+    return id
 
 
-def build_and_save_all_retro():
-    for id in retro_ids():
-        print(id)
-        build_and_save_one(retro_proc_dir(id))
+def build_and_save_all_retro(processes=2):
+    # each subject holds its recordings in memory, so keep the pool small;
+    # each one writes its own files, so report them as they finish
+    with multiprocessing.Pool(processes) as pool:
+        for id in pool.imap_unordered(_build_and_save_retro, retro_ids(),
+                                      chunksize=1):
+            print(id)
 
 
 def plot_dataset(subj_proc_dir, data):
@@ -244,6 +317,7 @@ def plot_dataset(subj_proc_dir, data):
     pl.tight_layout()
     pl.savefig(os.path.join(
         subj_proc_dir, 'vep', 'data.png'))
+    pl.close()
 
 # testing
 # spd = retro_proc_dir('id023_br')
@@ -253,5 +327,5 @@ def plot_dataset(subj_proc_dir, data):
 
 if __name__ == '__main__':
     subj_proc_dir, = sys.argv[1:]
-    build_and_save_one(subj_proc_dir)
+    build_and_save_one(subj_proc_dir, workers=os.cpu_count())
     